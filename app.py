@@ -1,17 +1,22 @@
 # -*- coding: utf-8 -*-
 import os
 import json
+import hashlib
+import heapq
+import queue
 import sqlite3
+import threading
+import time
 import urllib.request
 import urllib.error
 
 from io import BytesIO
-from datetime import date, datetime
-from functools import wraps
+from datetime import date, datetime, timedelta
+from functools import lru_cache, wraps
 
 from flask import (
-    Flask, g, render_template,
-    request, redirect, url_for, session, flash,
+    Flask, g, render_template, stream_template,
+    request, redirect, url_for, session, flash, get_flashed_messages,
     send_file
 )
 
@@ -30,6 +35,10 @@ BASE_DIR = os.path.dirname(__file__)
 # - Local development    → ./data.db
 DATABASE = os.environ.get("DATABASE_PATH") or os.path.join(BASE_DIR, "data.db")
 
+# نسخة مخطط قاعدة البيانات (PRAGMA user_version)
+# ارفع الرقم عند إضافة جدول/عمود/فهرس جديد حتى تُعاد فحوصات المخطط مرة واحدة
+SCHEMA_VERSION = 5
+
 # المستخدم الرئيسي (فقط هذا يدخل صفحة الصلاحيات)
 MASTER_USERNAME = "adm-es"
 
@@ -57,6 +66,12 @@ PERM_KEYS = [
     "permissions",
 ]
 
+# القيم الافتراضية (كلها False) — تُنسخ بدل بنائها في كل تحميل صلاحيات
+_DEFAULT_PERMS = dict.fromkeys(PERM_KEYS, False)
+
+# أسماء حقول الصلاحيات في نموذج صفحة الصلاحيات (perm_<key>)
+_PERM_FORM_KEYS = tuple(("perm_" + k, k) for k in PERM_KEYS)
+
 PERM_LABELS = {
     "home": "الرئيسية",
     "accounting_home": "المحاسبة المالية ",
@@ -82,30 +97,67 @@ PERM_LABELS = {
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("APP_SECRET", "change-this-secret")
+# القوالب لا تتغير أثناء التشغيل: لا داعي لفحص ملفاتها مع كل render
+app.config["TEMPLATES_AUTO_RELOAD"] = False
 
 
 # =========================
 # DB helpers (SQLite مؤقتًا)
 # =========================
+# اتصالات جاهزة يعاد استخدامها بين الطلبات بدل فتح ملف القاعدة كل مرة
+_POOL = queue.LifoQueue(maxsize=8)
+_WAL_READY = False
+
+
+def _connect():
+    global _WAL_READY
+    db = sqlite3.connect(DATABASE, check_same_thread=False, cached_statements=256)
+    db.row_factory = sqlite3.Row
+    # WAL يُحفظ في ملف القاعدة نفسه: يكفي مرة واحدة لكل عملية
+    # باقي الـ PRAGMAs خاصة بالاتصال، وتُنفذ مرة لكل اتصال (الاتصالات تُعاد من الـ pool)
+    if not _WAL_READY:
+        db.execute("PRAGMA journal_mode=WAL")
+        _WAL_READY = True
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute("PRAGMA busy_timeout=5000")
+    db.execute("PRAGMA foreign_keys=ON")
+    db.execute("PRAGMA temp_store=MEMORY")
+    db.execute("PRAGMA cache_size=-20000")
+    db.execute("PRAGMA mmap_size=268435456")
+    return db
+
+
 def get_db():
-    db = getattr(g, "_db", None)
+    db = g.get("_db")
     if db is None:
-        db = sqlite3.connect(DATABASE)
-        db.row_factory = sqlite3.Row
+        try:
+            db = _POOL.get_nowait()
+        except queue.Empty:
+            db = _connect()
         g._db = db
     return db
 
 
 @app.teardown_appcontext
 def close_db(exception):
-    db = getattr(g, "_db", None)
-    if db is not None:
+    db = g.pop("_db", None)
+    if db is None:
+        return
+
+    # لا نرجع اتصال فيه معاملة مفتوحة للـ pool
+    if db.in_transaction:
+        db.rollback()
+
+    try:
+        _POOL.put_nowait(db)
+    except queue.Full:
         db.close()
 
 
 def init_db():
     """Run schema.sql once manually (first run) OR call from __main__ (محلي فقط)."""
     db = sqlite3.connect(DATABASE)
+    db.execute("PRAGMA journal_mode=WAL")
     schema_path = os.path.join(BASE_DIR, "schema.sql")
     with open(schema_path, "r", encoding="utf-8") as f:
         db.executescript(f.read())
@@ -123,6 +175,21 @@ def _table_exists(db, name: str) -> bool:
     except Exception:
         return False
 
+def _ensure_unique_index(db, name: str, table: str, cols: tuple):
+    """Create a UNIQUE index on cols unless an equivalent one (PK/UNIQUE) exists."""
+    for idx in db.execute(f"PRAGMA index_list({table})").fetchall():
+        if not idx["unique"]:
+            continue
+        idx_cols = tuple(r["name"] for r in db.execute(f"PRAGMA index_info({idx['name']})").fetchall())
+        if idx_cols == tuple(cols):
+            return
+
+    try:
+        db.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {name} ON {table}({', '.join(cols)})")
+    except sqlite3.IntegrityError as e:
+        print(f"unique index {name} skipped (duplicate rows):", e)
+
+
 def ensure_db_schema_once():
     """Ensure schema.sql has been applied (safe to call multiple times)."""
     if app.config.get("DB_BOOTSTRAPPED"):
@@ -144,7 +211,10 @@ def ensure_db_schema_once():
 
 
 def ensure_financial_commitments_schema(db):
-    """Ensure financial_commitments table exists and has task_id column."""
+    """Ensure financial_commitments table exists and has task_id column (once per process)."""
+    if app.config.get("COMMITMENTS_READY"):
+        return
+
     db.execute("""
     CREATE TABLE IF NOT EXISTS financial_commitments (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -161,6 +231,7 @@ def ensure_financial_commitments_schema(db):
         db.execute("ALTER TABLE financial_commitments ADD COLUMN task_id INTEGER")
 
     db.commit()
+    app.config["COMMITMENTS_READY"] = True
 
 
 def ensure_debts_ledger_schema(db):
@@ -214,47 +285,128 @@ def ensure_debts_ledger_schema(db):
 
 
 def ensure_master_user():
-    """Ensure master user exists and has ALL perms = 1."""
+    """Ensure master user exists and has ALL perms = 1 (once per process)."""
+    if app.config.get("MASTER_READY"):
+        return
+
     db = get_db()
 
     row = db.execute("SELECT id FROM users WHERE username=?", (MASTER_USERNAME,)).fetchone()
-    if row:
-        uid = row["id"]
-    else:
-        default_pass = os.environ.get("MASTER_PASS", "1234")
-        db.execute(
-            "INSERT INTO users (username, password_hash, is_admin, created_at) VALUES (?, ?, 1, ?)",
-            (MASTER_USERNAME, generate_password_hash(default_pass), datetime.now().isoformat()),
-        )
-        db.commit()
-        uid = db.execute(
-            "SELECT id FROM users WHERE username=?",
-            (MASTER_USERNAME,),
-        ).fetchone()["id"]
+    with db:
+        if row:
+            uid = row["id"]
+        else:
+            default_pass = os.environ.get("MASTER_PASS", "1234")
+            cur = db.execute(
+                "INSERT INTO users (username, password_hash, is_admin, created_at) "
+                "VALUES (?, ?, 1, strftime('%Y-%m-%dT%H:%M:%f', 'now'))",
+                (MASTER_USERNAME, generate_password_hash(default_pass)),
+            )
+            uid = cur.lastrowid
 
-    for k in PERM_KEYS:
-        db.execute(
+        db.executemany(
             """
             INSERT INTO permissions (user_id, perm_key, allowed)
             VALUES (?, ?, 1)
             ON CONFLICT(user_id, perm_key) DO UPDATE SET allowed=1
             """,
-            (uid, k),
+            [(uid, k) for k in PERM_KEYS],
         )
-    db.commit()
+
+    app.config["MASTER_READY"] = True
+
+
+def migrate_records_tables(db):
+    """Copy records_es1/2/3 into the single records(kind, id, ...) table and keep the old ones as *_old."""
+    # BEGIN IMMEDIATE: لو أكثر من عامل gunicorn بدأ معاً، واحد فقط ينقل البيانات
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS records (
+              kind TEXT NOT NULL,
+              id INTEGER NOT NULL,
+              record_type TEXT,
+              record_number TEXT NOT NULL,
+              expiry_date TEXT,
+              PRIMARY KEY (kind, id)
+            )
+        """)
+        # أعلى id صدر لكل kind (بديل sqlite_sequence للجداول القديمة)
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS records_seq (
+              kind TEXT PRIMARY KEY,
+              last_id INTEGER NOT NULL
+            )
+        """)
+        has_sequence = _table_exists(db, "sqlite_sequence")
+        for kind in ("ES1", "ES2", "ES3"):
+            old = f"records_{kind.lower()}"
+            last_id = 0
+            if _table_exists(db, old):
+                db.execute(f"""
+                    INSERT OR IGNORE INTO records (kind, id, record_type, record_number, expiry_date)
+                    SELECT ?, id, record_type, record_number, expiry_date FROM {old}
+                """, (kind,))
+                if has_sequence:
+                    row = db.execute("SELECT seq FROM sqlite_sequence WHERE name=?", (old,)).fetchone()
+                    last_id = row[0] if row else 0
+                # إعادة تسمية لا حذف: البيانات القديمة تبقى للرجوع، وتُحذف في إصدار لاحق بعد التأكد
+                if not _table_exists(db, f"{old}_old"):
+                    db.execute(f"ALTER TABLE {old} RENAME TO {old}_old")
+            db.execute("""
+                INSERT INTO records_seq (kind, last_id)
+                SELECT ?, MAX(?, COALESCE(MAX(id), 0)) FROM records WHERE kind=?
+                ON CONFLICT(kind) DO UPDATE SET last_id = MAX(last_id, excluded.last_id)
+            """, (kind, last_id, kind))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+
+_BOOTSTRAP_LOCK = threading.Lock()
+
+
+def bootstrap_once():
+    """Schema checks + master user: run once per process, not per request."""
+    with _BOOTSTRAP_LOCK:
+        if app.config.get("BOOTSTRAP_READY"):
+            return
+
+        try:
+            ensure_db_schema_once()
+            db = get_db()
+
+            version = db.execute("PRAGMA user_version").fetchone()[0]
+            if version < SCHEMA_VERSION:
+                ensure_financial_commitments_schema(db)
+                ensure_debts_ledger_schema(db)
+                migrate_records_tables(db)
+
+                # فلتر تنبيهات المهام (تاريخ الانتهاء <= نافذة 45 يوم) يصير range scan على الفهرس
+                db.execute("CREATE INDEX IF NOT EXISTS idx_records_expiry ON records(expiry_date)")
+                db.execute("CREATE INDEX IF NOT EXISTS idx_emp_passport_expiry ON employees(passport_expiry)")
+                db.execute("CREATE INDEX IF NOT EXISTS idx_emp_iqama_expiry ON employees(iqama_expiry)")
+                db.execute("CREATE INDEX IF NOT EXISTS idx_emp_insurance_expiry ON employees(insurance_expiry)")
+
+                # ON CONFLICT(user_id, perm_key) و WHERE username=? يحتاجون فهرس فريد
+                _ensure_unique_index(db, "idx_perm_user_key", "permissions", ("user_id", "perm_key"))
+                _ensure_unique_index(db, "idx_users_username", "users", ("username",))
+
+                db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+                db.commit()
+
+            ensure_master_user()
+            app.config["BOOTSTRAP_READY"] = True
+        except Exception as e:
+            print("bootstrap error:", e)
 
 
 @app.before_request
 def _ensure_bootstrap():
-    try:
-        ensure_db_schema_once()
-        db = get_db()
-        ensure_financial_commitments_schema(db)
-        ensure_debts_ledger_schema(db)
-        ensure_master_user()
-    except Exception as e:
-        print("bootstrap error:", e)
-        pass
+    if request.endpoint == "static" or app.config.get("BOOTSTRAP_READY"):
+        return
+    bootstrap_once()
 
 # =========================
 # Financial Commitments -> Tasks helpers
@@ -264,6 +416,7 @@ def _commitment_task_title(party, amount):
 
 
 def create_or_update_commitment_task(db, commitment_id):
+    """Sync the commitment's task row. Runs inside the caller's transaction (caller commits)."""
     row = db.execute(
         "SELECT party, amount, task_id FROM financial_commitments WHERE id=?",
         (commitment_id,),
@@ -275,12 +428,12 @@ def create_or_update_commitment_task(db, commitment_id):
 
     if row["task_id"]:
         db.execute("UPDATE tasks SET title=? WHERE id=?", (title, row["task_id"]))
-        db.commit()
         return
 
     cur = db.execute(
-        "INSERT INTO tasks (title, due_date, created_at) VALUES (?, ?, ?)",
-        (title, None, datetime.now().isoformat()),
+        "INSERT INTO tasks (title, due_date, created_at) "
+        "VALUES (?, NULL, strftime('%Y-%m-%dT%H:%M:%f', 'now'))",
+        (title,),
     )
     task_id = cur.lastrowid
 
@@ -288,10 +441,10 @@ def create_or_update_commitment_task(db, commitment_id):
         "UPDATE financial_commitments SET task_id=? WHERE id=?",
         (task_id, commitment_id),
     )
-    db.commit()
 
 
 def delete_commitment_task(db, commitment_id):
+    """Delete the commitment's task row. Runs inside the caller's transaction (caller commits)."""
     row = db.execute(
         "SELECT task_id FROM financial_commitments WHERE id=?",
         (commitment_id,),
@@ -299,7 +452,6 @@ def delete_commitment_task(db, commitment_id):
 
     if row and row["task_id"]:
         db.execute("DELETE FROM tasks WHERE id=?", (row["task_id"],))
-        db.commit()
 
 
 # =========================
@@ -311,9 +463,26 @@ def delete_commitment_task(db, commitment_id):
 #
 # ملاحظة: كل التبويبات فيها id مخفي، بنعتمد upsert/delete على العمود A دائماً.
 
+_GS_LOCK = threading.Lock()
+_GS_CONFIG = None            # (url, token) — تُقرأ من البيئة مرة واحدة
+_GS_HEADERS_READY = {}       # {(tab, headers): وقت التأكد} تم التأكد من هيدرزها في هذه العملية
+_GS_HEADERS_TTL = 3600       # نعيد التأكد كل ساعة (لو أحد عدّل الشيت يدوياً)
+
+
+def _gs_config():
+    global _GS_CONFIG
+    if _GS_CONFIG is None:
+        with _GS_LOCK:
+            if _GS_CONFIG is None:
+                _GS_CONFIG = (
+                    (os.environ.get("GOOGLE_APPS_SCRIPT_URL") or "").strip(),
+                    (os.environ.get("GOOGLE_SHEETS_TOKEN") or "").strip(),
+                )
+    return _GS_CONFIG
+
+
 def _gs_enabled() -> bool:
-    url = (os.environ.get("GOOGLE_APPS_SCRIPT_URL") or "").strip()
-    token = (os.environ.get("GOOGLE_SHEETS_TOKEN") or "").strip()
+    url, token = _gs_config()
     return bool(url) and bool(token)
 
 
@@ -328,8 +497,7 @@ def _gs_post(payload: dict):
         print("GS: not configured (missing GOOGLE_APPS_SCRIPT_URL or GOOGLE_SHEETS_TOKEN)")
         return None, "gs_not_configured"
 
-    url = (os.environ.get("GOOGLE_APPS_SCRIPT_URL") or "").strip()
-    token = (os.environ.get("GOOGLE_SHEETS_TOKEN") or "").strip()
+    url, token = _gs_config()
 
     payload = dict(payload or {})
     payload["token"] = token
@@ -377,6 +545,12 @@ def _gs_post(payload: dict):
         return None, f"request_failed:{e}"
 
 
+@lru_cache(maxsize=64)
+def _clean_headers(headers: tuple) -> tuple:
+    """Normalized header names, computed once per distinct headers tuple."""
+    return tuple(str(h).strip() for h in headers)
+
+
 def gs_post(action: str, tab: str, headers=None, row=None, row_id=None, rows=None):
     """
     Wrapper متوافق مع Apps Script الحالي:
@@ -400,7 +574,7 @@ def gs_post(action: str, tab: str, headers=None, row=None, row_id=None, rows=Non
         payload = {
             "action": "ensure_headers",
             "sheet": tab,
-            "headers": [str(h).strip() for h in (headers or [])],
+            "headers": list(_clean_headers(tuple(headers or []))),
         }
         return _gs_post(payload)
 
@@ -422,7 +596,7 @@ def gs_post(action: str, tab: str, headers=None, row=None, row_id=None, rows=Non
         if row_id is None:
             return None, "missing_row_id"
 
-        headers_clean = [str(h).strip() for h in headers]
+        headers_clean = _clean_headers(tuple(headers))
         if not headers_clean or headers_clean[0].lower() != "id":
             return None, "headers_must_start_with_id"
 
@@ -456,7 +630,7 @@ def gs_post(action: str, tab: str, headers=None, row=None, row_id=None, rows=Non
         payload = {
             "action": "replace_all",
             "sheet": tab,
-            "headers": [str(h).strip() for h in (headers or [])],
+            "headers": list(_clean_headers(tuple(headers or []))),
             "rows": rows,
         }
         return _gs_post(payload)
@@ -478,13 +652,22 @@ def open_ws(tab_name: str):
 def ws_ensure_headers(ws, headers):
     if not ws:
         return False
-    headers = [str(h).strip() for h in (headers or []) if str(h).strip()]
+    headers = tuple(h for h in _clean_headers(tuple(headers or [])) if h)
     if not headers:
         return False
+
+    key = (str(ws), headers)
+    checked_at = _GS_HEADERS_READY.get(key)
+    if checked_at is not None and time.monotonic() - checked_at < _GS_HEADERS_TTL:
+        return True
+
     _, err = gs_post("ensure_headers", tab=str(ws), headers=headers)
     if err:
         print("ws_ensure_headers error:", err)
         return False
+
+    with _GS_LOCK:
+        _GS_HEADERS_READY[key] = time.monotonic()
     return True
 
 
@@ -492,7 +675,7 @@ def ws_upsert(ws, headers, row_values, row_id):
     if not ws:
         return False
 
-    headers_clean = [str(h).strip() for h in (headers or [])]
+    headers_clean = _clean_headers(tuple(headers or []))
     if not headers_clean or headers_clean[0].lower() != "id":
         print("ws_upsert error: headers must start with 'id'")
         return False
@@ -515,6 +698,9 @@ def ws_upsert(ws, headers, row_values, row_id):
     _, err = _gs_post(payload)
     if err:
         print("ws_upsert error:", err)
+        # ربما انحذف التبويب أو تغيّر: نعيد التأكد من الهيدرز في المرة القادمة
+        with _GS_LOCK:
+            _GS_HEADERS_READY.pop((str(ws), headers_clean), None)
         return False
     return True
 
@@ -545,6 +731,82 @@ def ws_replace_all(tab_name: str, headers: list, rows: list):
     return True
 
 
+# =========
+# مزامنة Sheets في الخلفية: الطلب يضيف العملية للطابور ويرجع فوراً
+# العمليات: ("upsert", tab, headers, row_values, row_id) / ("delete", tab, row_id)
+# العامل يجمع ما يصل خلال نافذة قصيرة ويرسل آخر عملية لكل (tab, id) فقط
+# =========
+_GS_Q = queue.Queue()
+_GS_WORKER = None
+_GS_BATCH_WINDOW = 0.2
+
+
+def _gs_coalesce(ops):
+    last = {}
+    for op in ops:
+        key = (op[1], str(op[-1]))
+        last.pop(key, None)
+        last[key] = op
+    return list(last.values())
+
+
+def _gs_apply(op):
+    action, tab = op[0], op[1]
+    ws, err = open_ws(tab)
+    if err:
+        return False
+    if action == "upsert":
+        _, _, headers, row_values, row_id = op
+        return ws_upsert(ws, headers, row_values, row_id)
+    if action == "delete":
+        return ws_delete_by_id(ws, op[2])
+    print("gs op unknown action:", action)
+    return False
+
+
+def gs_flush(ops):
+    for op in _gs_coalesce(ops):
+        try:
+            _gs_apply(op)
+        except Exception as e:
+            print(f"Google Sheets sync ({op[0]}/{op[1]}) error:", e)
+
+
+def _gs_worker():
+    while True:
+        ops = [_GS_Q.get()]
+        deadline = time.monotonic() + _GS_BATCH_WINDOW
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                ops.append(_GS_Q.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        gs_flush(ops)
+        for _ in ops:
+            _GS_Q.task_done()
+
+
+def _gs_start_worker():
+    # يبدأ عند أول استخدام (وليس عند الاستيراد) حتى يعمل داخل كل عامل gunicorn
+    global _GS_WORKER
+    with _GS_LOCK:
+        if _GS_WORKER is None or not _GS_WORKER.is_alive():
+            _GS_WORKER = threading.Thread(target=_gs_worker, name="gs-sync", daemon=True)
+            _GS_WORKER.start()
+
+
+def gs_enqueue(action: str, tab: str, *args):
+    """Queue a Sheets write for the background worker."""
+    if not _gs_enabled():
+        return
+    _gs_start_worker()
+    _GS_Q.put((action, tab) + args)
+
+
 # =========================
 # Debug routes (مؤقتة للتشخيص)
 # =========================
@@ -571,19 +833,114 @@ def debug_gs():
 # =========================
 # Auth + permissions
 # =========================
+# كاش صلاحيات المستخدمين داخل العملية: user_id -> (perms, loaded_at)
+# يُمسح عند أي تعديل من صفحة الصلاحيات، والـ TTL يغطي عمال gunicorn الآخرين
+_PERM_CACHE: dict = {}
+_PERM_CACHE_LOCK = threading.Lock()
+_PERM_CACHE_TTL = 60
+
+
+def invalidate_user_perms(user_id=None):
+    with _PERM_CACHE_LOCK:
+        if user_id is None:
+            _PERM_CACHE.clear()
+        else:
+            _PERM_CACHE.pop(user_id, None)
+
+
 def load_user_perms(user_id: int) -> dict:
+    now = time.monotonic()
+    with _PERM_CACHE_LOCK:
+        hit = _PERM_CACHE.get(user_id)
+    if hit and now - hit[1] < _PERM_CACHE_TTL:
+        return dict(hit[0])
+
     db = get_db()
     rows = db.execute(
         "SELECT perm_key, allowed FROM permissions WHERE user_id=?",
         (user_id,),
     ).fetchall()
 
-    perms = {k: False for k in PERM_KEYS}
+    perms = _DEFAULT_PERMS.copy()
     for r in rows:
         perms[r["perm_key"]] = bool(r["allowed"])
+
+    with _PERM_CACHE_LOCK:
+        _PERM_CACHE[user_id] = (perms, now)
+    return dict(perms)
+
+
+# كاش بيانات الدخول: username -> (user, loaded_at)
+# check_password_hash يبقى يُحسب كل مرة؛ الكاش يوفر استعلام القاعدة فقط
+# يُمسح عند تغيير كلمة مرور أو حذف مستخدم، والـ TTL قصير لأن العمال الآخرين ما يوصلهم المسح
+_LOGIN_CACHE: dict = {}
+_LOGIN_CACHE_LOCK = threading.Lock()
+_LOGIN_CACHE_TTL = 30
+
+
+def invalidate_login_cache():
+    with _LOGIN_CACHE_LOCK:
+        _LOGIN_CACHE.clear()
+
+
+def _load_login_user(username: str):
+    now = time.monotonic()
+    with _LOGIN_CACHE_LOCK:
+        hit = _LOGIN_CACHE.get(username)
+    if hit and now - hit[1] < _LOGIN_CACHE_TTL:
+        return hit[0]
+
+    row = get_db().execute(
+        "SELECT id, username, password_hash, is_admin FROM users WHERE username=?",
+        (username,),
+    ).fetchone()
+    if row is None:
+        return None
+
+    user = dict(row)
+    with _LOGIN_CACHE_LOCK:
+        _LOGIN_CACHE[username] = (user, now)
+    return user
+
+
+def current_perms() -> dict:
+    """Perms of the logged-in user, kept server-side (not in the session cookie)."""
+    perms = g.get("_perms")
+    if perms is None:
+        uid = session.get("user_id")
+        perms = load_user_perms(uid) if uid else {}
+        g._perms = perms
     return perms
 
 
+def page_etag(*parts) -> str:
+    """ETag for a rendered page: its data plus what base.html depends on (user, perms, day)."""
+    key = (
+        session.get("user_id"),
+        session.get("username"),
+        sorted(current_perms().items()),
+        date.today().isoformat(),
+        parts,
+    )
+    return hashlib.blake2b(repr(key).encode("utf-8"), digest_size=16).hexdigest()
+
+
+def not_modified(etag):
+    """304 response if the client already has this version of the page, else None."""
+    # رسائل flash المعلقة لازم تنعرض، فلا نرجع 304 وقتها
+    if "_flashes" in session or not request.if_none_match.contains(etag):
+        return None
+    resp = app.response_class(status=304)
+    return with_etag(resp, etag)
+
+
+def with_etag(resp, etag):
+    resp.set_etag(etag)
+    resp.cache_control.private = True
+    resp.cache_control.no_cache = True
+    return resp
+
+
 def login_required(fn):
     @wraps(fn)
     def wrapper(*args, **kwargs):
@@ -593,18 +950,34 @@ def login_required(fn):
     return wrapper
 
 
-def permission_required(perm_key: str):
-    def deco(fn):
-        @wraps(fn)
-        def wrapper(*args, **kwargs):
-            if not session.get("logged_in"):
-                return redirect(url_for("login"))
-            perms = session.get("perms") or {}
-            if not bool(perms.get(perm_key)):
-                return render_template("no_permission.html"), 403
-            return fn(*args, **kwargs)
-        return wrapper
-    return deco
+# صلاحية كل صفحة: endpoint -> perm_key (يُفحص مرة واحدة في before_request)
+_ROUTE_PERMS = {
+    "home": "home",
+    "accounting_home": "accounting_home",
+    "accounting_commitments_home": "financial_commitments",
+    "accounting_debts": "accounting_home",
+    "monthly_commission": "monthly_commission",
+    "records_home": "records_home",
+    "employees_list": "employees",
+    "employee_new": "employees",
+    "employee_detail": "employees",
+    "employee_edit": "employees",
+    "employee_delete": "employees",
+    "tasks": "tasks",
+    "task_delete": "tasks",
+}
+
+
+@app.before_request
+def _check_route_perm():
+    perm_key = _ROUTE_PERMS.get(request.endpoint)
+    if perm_key is None:
+        return None
+    if not session.get("logged_in"):
+        return redirect(url_for("login"))
+    if not current_perms().get(perm_key, False):
+        return render_template("no_permission.html"), 403
+    return None
 
 
 def admin_required(fn):
@@ -615,8 +988,7 @@ def admin_required(fn):
             return redirect(url_for("login"))
         if session.get("username") != MASTER_USERNAME:
             return render_template("no_permission.html"), 403
-        perms = session.get("perms") or {}
-        if not bool(perms.get("permissions")):
+        if not bool(current_perms().get("permissions")):
             return render_template("no_permission.html"), 403
         return fn(*args, **kwargs)
     return wrapper
@@ -634,14 +1006,16 @@ def parse_date(s: str):
         return None
 
 
-def days_left(expiry):
-    if expiry is None:
-        return None
-    return (expiry - date.today()).days
+@app.template_filter("date")
+@lru_cache(maxsize=4096)
+def date_filter(s):
+    # نفس تاريخ الانتهاء يتكرر بين الصفوف: يُحلل مرة واحدة فقط
+    return parse_date(s) if s else None
 
 
-def status_color(expiry):
-    dl = days_left(expiry)
+# دالة نقية على عدد الأيام (قيم قليلة مكررة)، فالكاش آمن بين الطلبات والعمال
+@lru_cache(maxsize=128)
+def _status_for_days(dl):
     if dl is None:
         return "bg-blue"
     if dl > 45:
@@ -653,10 +1027,22 @@ def status_color(expiry):
 
 @app.context_processor
 def inject_helpers():
+    # تاريخ اليوم مرة واحدة لكل صفحة بدل date.today() لكل صف
+    today = date.today()
+
+    def _days_left(expiry):
+        if expiry is None:
+            return None
+        return (expiry - today).days
+
+    def _status_color(expiry):
+        return _status_for_days(_days_left(expiry))
+
     return {
         "APP_TITLE": APP_TITLE,
-        "days_left": days_left,
-        "status_color": status_color,
+        "days_left": _days_left,
+        "status_color": _status_color,
+        "perms": current_perms(),
         "perm_labels": PERM_LABELS,
         "perm_keys": PERM_KEYS,
     }
@@ -678,11 +1064,7 @@ def login():
         u = request.form.get("username", "").strip()
         p = request.form.get("password", "").strip()
 
-        db = get_db()
-        user = db.execute(
-            "SELECT id, username, password_hash, is_admin FROM users WHERE username=?",
-            (u,),
-        ).fetchone()
+        user = _load_login_user(u)
 
         if user and check_password_hash(user["password_hash"], p):
             session.clear()
@@ -690,7 +1072,6 @@ def login():
             session["user_id"] = user["id"]
             session["username"] = user["username"]
             session["is_admin"] = int(user["is_admin"] or 0) == 1
-            session["perms"] = load_user_perms(user["id"])
             return redirect(url_for("home"))
 
         flash("اسم المستخدم أو كلمة المرور غير صحيحة", "danger")
@@ -706,7 +1087,6 @@ def logout():
 
 @app.route("/home")
 @login_required
-@permission_required("home")
 def home():
     return render_template("home.html")
 
@@ -716,12 +1096,14 @@ def home():
 # =========================
 @app.route("/accounting")
 @login_required
-@permission_required("accounting_home")
 def accounting_home():
     return render_template("accounting_home.html")
 
 
 def ensure_daily_accounting_schema(db):
+    if app.config.get("DAILY_SCHEMA_READY"):
+        return
+
     db.execute("PRAGMA foreign_keys = ON")
 
     db.execute("""
@@ -782,11 +1164,6 @@ def ensure_daily_accounting_schema(db):
         )
     """)
 
-    db.execute("""
-        CREATE INDEX IF NOT EXISTS idx_daily_header_es_date
-        ON daily_header(es, day_date)
-    """)
-
     cols = [r[1] for r in db.execute("PRAGMA table_info(daily_header)").fetchall()]
 
     if "total_in_enjaz" not in cols:
@@ -800,7 +1177,19 @@ def ensure_daily_accounting_schema(db):
     if "payment_kind" not in gen_cols:
         db.execute("ALTER TABLE daily_expenses_general ADD COLUMN payment_kind TEXT NOT NULL DEFAULT 'debt'")
 
+    # فهارس تغطي استعلام الحركات: رأس اليوم بنطاق التاريخ + مجاميع الجداول الفرعية حسب header_id
+    db.execute("""
+        CREATE INDEX IF NOT EXISTS idx_daily_header_es_date_cov
+        ON daily_header(es, day_date, cash_start, cash_end, cash_received, mada, total_in_enjaz)
+    """)
+    db.execute("DROP INDEX IF EXISTS idx_daily_header_es_date")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_di_header ON daily_inputs(header_id, amount)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_dte_header ON daily_tamara_emkan(header_id, amount)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_deg_header ON daily_expenses_general(header_id, amount)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_dep_header ON daily_expenses_petty(header_id, amount)")
+
     db.commit()
+    app.config["DAILY_SCHEMA_READY"] = True
 
 
 def _normalize_kind(kind: str) -> str:
@@ -816,7 +1205,7 @@ def _require_accounting_kind_perm(kind: str):
         return None, ("Not Found", 404)
 
     perm_key = f"accounting_{kind.lower()}"
-    if not bool((session.get("perms") or {}).get(perm_key)):
+    if not bool(current_perms().get(perm_key)):
         return None, (render_template("no_permission.html"), 403)
 
     return kind, None
@@ -834,17 +1223,42 @@ def accounting_es(kind):
 
 
 def _to_float(v, default=0.0):
+    # المسار السريع: القيم القادمة من SQLite أرقام جاهزة
+    t = type(v)
+    if t is float:
+        return v
+    if t is int:
+        return float(v)
+    if v is None or v == "":
+        return float(default)
+
     try:
-        if v is None:
-            return float(default)
-        s = str(v).strip().replace(",", "")
-        if s == "":
-            return float(default)
-        return float(s)
-    except Exception:
+        if t is str:
+            # مدخلات النماذج: "1,000" أو " 5 "
+            return float(v.replace(",", "").strip())
+        return float(v)
+    except (TypeError, ValueError):
         return float(default)
 
 
+# حذف صفوف اليوم قبل إعادة إدخالها (جمل ثابتة تبقى في كاش sqlite)
+# لا نستخدم executescript لأنه يعمل COMMIT ويكسر معاملة الحفظ الواحدة
+_DAILY_CHILD_DELETES = (
+    "DELETE FROM daily_inputs WHERE header_id=?",
+    "DELETE FROM daily_expenses_general WHERE header_id=?",
+    "DELETE FROM daily_expenses_petty WHERE header_id=?",
+)
+
+
+def _clean_pairs(types, amounts):
+    """Yield (type, amount) for the non-empty rows of a daily form section."""
+    for t, a in zip(types, amounts):
+        t = (t or "").strip()
+        amt = _to_float(a, 0)
+        if t or amt:
+            yield (t or "(بدون عنوان)", amt)
+
+
 @app.route("/accounting/<kind>/daily", methods=["GET", "POST"])
 @login_required
 def accounting_daily(kind):
@@ -871,63 +1285,16 @@ def accounting_daily(kind):
         total_in_enjaz = _to_float(request.form.get("total_in_enjaz"), 0)
         notes = (request.form.get("notes") or "").strip() or None
 
-        db.execute(
-            "INSERT OR IGNORE INTO daily_header (es, day_date, created_at) VALUES (?, ?, datetime('now'))",
-            (kind, day_date),
-        )
-
-        header = db.execute(
-            "SELECT id FROM daily_header WHERE es=? AND day_date=?",
-            (kind, day_date),
-        ).fetchone()
-
-        header_id = header["id"]
-
-        db.execute("""
-            UPDATE daily_header
-            SET cash_start=?,
-                cash_end=?,
-                cash_received=?,
-                mada=?,
-                total_in_enjaz=?,
-                notes=?,
-                updated_at=datetime('now')
-            WHERE id=?
-        """, (
-            cash_start,
-            cash_end,
-            cash_received,
-            mada,
-            total_in_enjaz,
-            notes,
-            header_id,
-        ))
-
-        db.execute("DELETE FROM daily_inputs WHERE header_id=?", (header_id,))
-        db.execute("DELETE FROM daily_expenses_general WHERE header_id=?", (header_id,))
-        db.execute("DELETE FROM daily_expenses_petty WHERE header_id=?", (header_id,))
-
-        input_types = request.form.getlist("input_type")
-        input_amounts = request.form.getlist("input_amount")
-
-        for t, a in zip(input_types, input_amounts):
-            t = (t or "").strip()
-            amt = _to_float(a, 0)
-
-            if t or amt:
-                if not t:
-                    t = "(بدون عنوان)"
-
-                db.execute(
-                    "INSERT INTO daily_inputs (header_id, input_type, amount) VALUES (?, ?, ?)",
-                    (header_id, t, amt),
-                )
+        form = request.form
 
-        gen_types = request.form.getlist("gen_type")
-        gen_kinds = request.form.getlist("gen_kind")
-        gen_amounts = request.form.getlist("gen_amount")
+        input_rows = list(_clean_pairs(form.getlist("input_type"), form.getlist("input_amount")))
 
-        for t, k, a in zip(gen_types, gen_kinds, gen_amounts):
+        gen_rows = []
+        for t, k, a in zip(
+            form.getlist("gen_type"),
+            form.getlist("gen_kind"),
+            form.getlist("gen_amount"),
+        ):
             t = (t or "").strip()
             k = (k or "debt").strip()
             amt = _to_float(a, 0)
@@ -941,37 +1308,78 @@ def accounting_daily(kind):
                 amt = abs(amt)
 
             if t or amt:
-                if not t:
-                    t = "(بدون عنوان)"
-
+                gen_rows.append((t or "(بدون عنوان)", k, amt))
+
+        petty_rows = list(_clean_pairs(form.getlist("petty_type"), form.getlist("petty_amount")))
+
+        # كل الحفظ في معاملة واحدة (commit واحد)
+        with db:
+            # BEGIN IMMEDIATE قبل الـ SELECT: فحص الوجود والـ INSERT ذريان، فحفظان متزامنان لنفس اليوم
+            # لا يصطدمان بـ UNIQUE(es, day_date)؛ الثاني ينتظر ثم يأخذ مسار UPDATE
+            db.execute("BEGIN IMMEDIATE")
+            # نجيب id اليوم إن وجد، وإلا نضيفه بكامل قيمه ونأخذ lastrowid (بدون SELECT ثاني)
+            header = db.execute(
+                "SELECT id FROM daily_header WHERE es=? AND day_date=?",
+                (kind, day_date),
+            ).fetchone()
+
+            if header:
+                header_id = header["id"]
                 db.execute("""
-                    INSERT INTO daily_expenses_general
-                    (header_id, expense_type, payment_kind, amount)
-                    VALUES (?, ?, ?, ?)
+                    UPDATE daily_header
+                    SET cash_start=?,
+                        cash_end=?,
+                        cash_received=?,
+                        mada=?,
+                        total_in_enjaz=?,
+                        notes=?,
+                        updated_at=datetime('now')
+                    WHERE id=?
                 """, (
+                    cash_start,
+                    cash_end,
+                    cash_received,
+                    mada,
+                    total_in_enjaz,
+                    notes,
                     header_id,
-                    t,
-                    k,
-                    amt
                 ))
+            else:
+                cur = db.execute("""
+                    INSERT INTO daily_header
+                    (es, day_date, cash_start, cash_end, cash_received, mada, total_in_enjaz, notes, created_at, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, datetime('now'), datetime('now'))
+                """, (
+                    kind,
+                    day_date,
+                    cash_start,
+                    cash_end,
+                    cash_received,
+                    mada,
+                    total_in_enjaz,
+                    notes,
+                ))
+                header_id = cur.lastrowid
 
-        petty_types = request.form.getlist("petty_type")
-        petty_amounts = request.form.getlist("petty_amount")
+            for sql in _DAILY_CHILD_DELETES:
+                db.execute(sql, (header_id,))
 
-        for t, a in zip(petty_types, petty_amounts):
-            t = (t or "").strip()
-            amt = _to_float(a, 0)
+            db.executemany(
+                "INSERT INTO daily_inputs (header_id, input_type, amount) VALUES (?, ?, ?)",
+                [(header_id, t, amt) for t, amt in input_rows],
+            )
 
-            if t or amt:
-                if not t:
-                    t = "(بدون عنوان)"
+            db.executemany("""
+                INSERT INTO daily_expenses_general
+                (header_id, expense_type, payment_kind, amount)
+                VALUES (?, ?, ?, ?)
+            """, [(header_id, t, k, amt) for t, k, amt in gen_rows])
 
-                db.execute(
-                    "INSERT INTO daily_expenses_petty (header_id, expense_type, amount) VALUES (?, ?, ?)",
-                    (header_id, t, amt),
-                )
+            db.executemany(
+                "INSERT INTO daily_expenses_petty (header_id, expense_type, amount) VALUES (?, ?, ?)",
+                [(header_id, t, amt) for t, amt in petty_rows],
+            )
 
-        db.commit()
         flash("تم حفظ المحاسبة اليومية بنجاح", "success")
         return redirect(url_for("accounting_daily", kind=kind, date=day_date))
 
@@ -984,39 +1392,38 @@ def accounting_daily(kind):
     inputs = []
     gen = []
     petty = []
+    totals = {"inputs": 0.0, "tamara": 0.0, "general": 0.0, "petty": 0.0}
 
     if header_id:
-        inputs = db.execute(
-            "SELECT input_type, amount FROM daily_inputs WHERE header_id=? ORDER BY id",
-            (header_id,),
-        ).fetchall()
-
-        gen = db.execute(
-            "SELECT expense_type, payment_kind, amount FROM daily_expenses_general WHERE header_id=? ORDER BY id",
-            (header_id,),
-        ).fetchall()
-
-        petty = db.execute(
-            "SELECT expense_type, amount FROM daily_expenses_petty WHERE header_id=? ORDER BY id",
-            (header_id,),
-        ).fetchall()
-
-    def _sum(rows):
-        return float(sum([_to_float(r["amount"], 0) for r in rows]))
-
-    def _sum_by_kind(rows, kinds):
-        return float(sum([
-            _to_float(r["amount"], 0)
-            for r in rows
-            if r["payment_kind"] in kinds
-        ]))
-
-    totals = {
-        "inputs": _sum(inputs),
-        "tamara": _sum_by_kind(gen, ("tamara", "emkan")),
-        "general": _sum_by_kind(gen, ("debt", "payment")),
-        "petty": _sum(petty),
-    }
+        # الجداول الثلاثة باستعلام واحد، والمجاميع تُحسب أثناء التوزيع
+        items = db.execute("""
+            SELECT 'i' AS k, id, input_type AS t, NULL AS payment_kind, amount
+              FROM daily_inputs WHERE header_id=?
+            UNION ALL
+            SELECT 'g', id, expense_type, payment_kind, amount
+              FROM daily_expenses_general WHERE header_id=?
+            UNION ALL
+            SELECT 'p', id, expense_type, NULL, amount
+              FROM daily_expenses_petty WHERE header_id=?
+            ORDER BY k, id
+        """, (header_id, header_id, header_id))
+
+        for r in items:
+            k = r["k"]
+            amt = _to_float(r["amount"], 0)
+
+            if k == "i":
+                inputs.append({"input_type": r["t"], "amount": r["amount"]})
+                totals["inputs"] += amt
+            elif k == "g":
+                gen.append({"expense_type": r["t"], "payment_kind": r["payment_kind"], "amount": r["amount"]})
+                if r["payment_kind"] in ("tamara", "emkan"):
+                    totals["tamara"] += amt
+                elif r["payment_kind"] in ("debt", "payment"):
+                    totals["general"] += amt
+            else:
+                petty.append({"expense_type": r["t"], "amount": r["amount"]})
+                totals["petty"] += amt
 
     cash_start = _to_float(header["cash_start"], 0) if header else 0.0
     cash_end = _to_float(header["cash_end"], 0) if header else 0.0
@@ -1068,140 +1475,133 @@ def accounting_movements(kind):
     date_from = (request.args.get("from") or "").strip() or date.today().isoformat()
     date_to = (request.args.get("to") or "").strip() or date.today().isoformat()
 
-    headers = db.execute("""
-        SELECT id,
-               day_date,
-               cash_start,
-               cash_end,
-               cash_received,
-               mada,
-               total_in_enjaz
-          FROM daily_header
-         WHERE es=?
-           AND day_date BETWEEN ? AND ?
+    # حساب كل يوم والإجماليات داخل SQLite باستعلام واحد:
+    # مجاميع الجداول الفرعية لأيام الفترة فقط، ثم الحقول المشتقة، ثم SUM() OVER () للإجماليات
+    rows = db.execute("""
+        WITH h AS (
+            SELECT id,
+                   day_date,
+                   COALESCE(cash_start, 0) AS cash_start,
+                   COALESCE(cash_end, 0) AS cash_end,
+                   COALESCE(cash_received, 0) AS cash_received,
+                   COALESCE(mada, 0) AS mada,
+                   COALESCE(total_in_enjaz, 0) AS total_in_enjaz
+              FROM daily_header
+             WHERE es=?
+               AND day_date BETWEEN ? AND ?
+        ),
+        i AS (
+            SELECT header_id, SUM(amount) AS s FROM daily_inputs
+             WHERE header_id IN (SELECT id FROM h) GROUP BY header_id
+        ),
+        te AS (
+            SELECT header_id, SUM(amount) AS s FROM daily_tamara_emkan
+             WHERE header_id IN (SELECT id FROM h) GROUP BY header_id
+        ),
+        g AS (
+            SELECT header_id, SUM(amount) AS s FROM daily_expenses_general
+             WHERE header_id IN (SELECT id FROM h) GROUP BY header_id
+        ),
+        p AS (
+            SELECT header_id, SUM(amount) AS s FROM daily_expenses_petty
+             WHERE header_id IN (SELECT id FROM h) GROUP BY header_id
+        ),
+        d AS (
+            SELECT h.day_date,
+                   h.cash_start,
+                   h.cash_end,
+                   h.cash_end - h.cash_start AS cash_diff,
+                   h.cash_received,
+                   COALESCE(te.s, 0) AS tamara,
+                   h.mada,
+                   COALESCE(i.s, 0) AS total_inputs,
+                   COALESCE(g.s, 0) AS total_general,
+                   COALESCE(p.s, 0) AS total_petty,
+                   h.total_in_enjaz
+              FROM h
+              LEFT JOIN i ON i.header_id = h.id
+              LEFT JOIN te ON te.header_id = h.id
+              LEFT JOIN g ON g.header_id = h.id
+              LEFT JOIN p ON p.header_id = h.id
+        ),
+        t AS (
+            SELECT d.*,
+                   (cash_end + cash_received + tamara + mada
+                    + total_inputs + total_general + total_petty) - cash_start AS total_overall
+              FROM d
+        )
+        SELECT t.*,
+               total_overall - total_in_enjaz AS error,
+               SUM(total_inputs) OVER () AS o_inputs,
+               SUM(tamara) OVER () AS o_tamara,
+               SUM(total_general) OVER () AS o_general,
+               SUM(total_petty) OVER () AS o_petty,
+               SUM(cash_start) OVER () AS o_cash_start,
+               SUM(cash_end) OVER () AS o_cash_end,
+               SUM(cash_diff) OVER () AS o_cash_diff,
+               SUM(cash_received) OVER () AS o_cash_received,
+               SUM(mada) OVER () AS o_mada,
+               SUM(total_in_enjaz) OVER () AS o_total_in_enjaz
+          FROM t
          ORDER BY day_date DESC
     """, (kind, date_from, date_to)).fetchall()
 
-    rows = []
-
-    overall_inputs = 0.0
-    overall_tamara = 0.0
-    overall_general = 0.0
-    overall_petty = 0.0
-    overall_cash_start = 0.0
-    overall_cash_end = 0.0
-    overall_cash_diff = 0.0
-    overall_cash_received = 0.0
-    overall_mada = 0.0
-    overall_total_in_enjaz = 0.0
-
-    for h in headers:
-        hid = h["id"]
-
-        total_inputs = _to_float(db.execute(
-            "SELECT COALESCE(SUM(amount),0) AS s FROM daily_inputs WHERE header_id=?",
-            (hid,)
-        ).fetchone()["s"], 0)
-
-        total_tamara = _to_float(db.execute(
-            "SELECT COALESCE(SUM(amount),0) AS s FROM daily_tamara_emkan WHERE header_id=?",
-            (hid,)
-        ).fetchone()["s"], 0)
-
-        total_general = _to_float(db.execute(
-            "SELECT COALESCE(SUM(amount),0) AS s FROM daily_expenses_general WHERE header_id=?",
-            (hid,)
-        ).fetchone()["s"], 0)
-
-        total_petty = _to_float(db.execute(
-            "SELECT COALESCE(SUM(amount),0) AS s FROM daily_expenses_petty WHERE header_id=?",
-            (hid,)
-        ).fetchone()["s"], 0)
-
-        cash_start = _to_float(h["cash_start"], 0)
-        cash_end = _to_float(h["cash_end"], 0)
-        cash_diff = cash_end - cash_start
-        cash_received = _to_float(h["cash_received"], 0)
-        mada = _to_float(h["mada"], 0)
-        total_in_enjaz = _to_float(h["total_in_enjaz"], 0)
-
-        total_overall = (
-            cash_end
-            + cash_received
-            + total_tamara
-            + mada
-            + total_inputs
-            + total_general
-            + total_petty
-        ) - cash_start
-
-        err_val = total_overall - total_in_enjaz
-
-        rows.append({
-            "day_date": h["day_date"],
-            "cash_start": cash_start,
-            "cash_end": cash_end,
-            "cash_diff": cash_diff,
-            "cash_received": cash_received,
-            "tamara": total_tamara,
-            "mada": mada,
-            "total_inputs": total_inputs,
-            "total_general": total_general,
-            "total_petty": total_petty,
-            "total_in_enjaz": total_in_enjaz,
-            "total_overall": total_overall,
-            "error": err_val,
-        })
-
-        overall_inputs += total_inputs
-        overall_tamara += total_tamara
-        overall_general += total_general
-        overall_petty += total_petty
-        overall_cash_start += cash_start
-        overall_cash_end += cash_end
-        overall_cash_diff += cash_diff
-        overall_cash_received += cash_received
-        overall_mada += mada
-        overall_total_in_enjaz += total_in_enjaz
-
-    overall_total_overall = (
-        overall_cash_end
-        + overall_cash_received
-        + overall_tamara
-        + overall_mada
-        + overall_inputs
-        + overall_general
-        + overall_petty
-    ) - overall_cash_start
-
-    overall_error = overall_total_overall - overall_total_in_enjaz
-
     overall = {
-        "inputs": overall_inputs,
-        "tamara": overall_tamara,
-        "general": overall_general,
-        "petty": overall_petty,
-        "cash_start": overall_cash_start,
-        "cash_end": overall_cash_end,
-        "cash_diff": overall_cash_diff,
-        "cash_received": overall_cash_received,
-        "mada": overall_mada,
-        "total_in_enjaz": overall_total_in_enjaz,
-        "total_overall": overall_total_overall,
-        "error": overall_error,
+        k: float(rows[0]["o_" + k]) if rows else 0.0
+        for k in (
+            "inputs", "tamara", "general", "petty",
+            "cash_start", "cash_end", "cash_diff",
+            "cash_received", "mada", "total_in_enjaz",
+        )
     }
 
-    return render_template(
+    overall["total_overall"] = (
+        overall["cash_end"]
+        + overall["cash_received"]
+        + overall["tamara"]
+        + overall["mada"]
+        + overall["inputs"]
+        + overall["general"]
+        + overall["petty"]
+    ) - overall["cash_start"]
+
+    overall["error"] = overall["total_overall"] - overall["total_in_enjaz"]
+
+    # نفس البيانات = نفس الصفحة: المتصفح يعيد استخدام نسخته بدل إعادة الرسم
+    etag = page_etag(kind, date_from, date_to, [tuple(r) for r in rows])
+    resp = not_modified(etag)
+    if resp is not None:
+        return resp
+
+    # الصفحة قد تطول لفترات سنة كاملة: نرسلها على دفعات بدل بناء HTML كامل في الذاكرة
+    # نسحب رسائل flash قبل البث لأن الجلسة تُحفظ قبل إرسال جسم الرد
+    get_flashed_messages()
+    return with_etag(app.response_class(_buffered_stream(stream_template(
         "accounting_movements.html",
         kind=kind,
         date_from=date_from,
         date_to=date_to,
         rows=rows,
         overall=overall,
-    )
+    ))), etag)
+
+
+def _buffered_stream(chunks, size=16384):
+    # Jinja يرجع قطع صغيرة جداً؛ نجمعها حتى لا يكون كل سطر كتابة مستقلة على الشبكة
+    buf = []
+    n = 0
+    for c in chunks:
+        buf.append(c)
+        n += len(c)
+        if n >= size:
+            yield "".join(buf)
+            buf = []
+            n = 0
+    if buf:
+        yield "".join(buf)
+
 @app.route("/accounting/commitments", methods=["GET", "POST"])
 @login_required
-@permission_required("financial_commitments")
 def accounting_commitments_home():
     db = get_db()
     ensure_financial_commitments_schema(db)
@@ -1217,14 +1617,15 @@ def accounting_commitments_home():
             amount = _to_float(request.form.get("amount"), 0)
 
             if party:
-                cur = db.execute(
-                    "INSERT INTO financial_commitments (party, amount) VALUES (?, ?)",
-                    (party, amount),
-                )
-                db.commit()
+                # الالتزام ومهمته في معاملة واحدة (commit واحد)
+                with db:
+                    cur = db.execute(
+                        "INSERT INTO financial_commitments (party, amount) VALUES (?, ?)",
+                        (party, amount),
+                    )
+                    cid = cur.lastrowid
+                    create_or_update_commitment_task(db, cid)
 
-                cid = cur.lastrowid
-                create_or_update_commitment_task(db, cid)
                 # --- Google Sheets upsert ---
                 try:
                     row = db.execute(
@@ -1257,13 +1658,12 @@ def accounting_commitments_home():
             party = (request.form.get("party") or "").strip()
             amount = _to_float(request.form.get("amount"), 0)
 
-            db.execute(
-                "UPDATE financial_commitments SET party=?, amount=?, updated_at=datetime('now') WHERE id=?",
-                (party, amount, cid),
-            )
-            db.commit()
-
-            create_or_update_commitment_task(db, cid)
+            with db:
+                db.execute(
+                    "UPDATE financial_commitments SET party=?, amount=?, updated_at=datetime('now') WHERE id=?",
+                    (party, amount, cid),
+                )
+                create_or_update_commitment_task(db, cid)
 
             # --- Google Sheets upsert ---
             try:
@@ -1294,7 +1694,9 @@ def accounting_commitments_home():
         elif action == "delete":
             cid = int(request.form.get("id") or 0)
 
-            delete_commitment_task(db, cid)
+            with db:
+                delete_commitment_task(db, cid)
+                db.execute("DELETE FROM financial_commitments WHERE id=?", (cid,))
 
             # --- Google Sheets delete ---
             try:
@@ -1308,22 +1710,28 @@ def accounting_commitments_home():
             except Exception as e:
                 print("Google Sheets export (tasks_commitment/delete) error:", e)
 
-            db.execute("DELETE FROM financial_commitments WHERE id=?", (cid,))
-            db.commit()
-
         return redirect(url_for("accounting_commitments_home"))
 
     rows = db.execute("SELECT * FROM financial_commitments ORDER BY id DESC").fetchall()
-    total = float(sum([_to_float(r["amount"], 0) for r in rows]))
-
-    return render_template("accounting_commitments_home.html", rows=rows, total=total)
+    total = float(db.execute(
+        "SELECT COALESCE(SUM(amount), 0) FROM financial_commitments"
+    ).fetchone()[0])
+
+    etag = page_etag([tuple(r) for r in rows], total)
+    resp = not_modified(etag)
+    if resp is not None:
+        return resp
+
+    return with_etag(
+        app.make_response(render_template("accounting_commitments_home.html", rows=rows, total=total)),
+        etag,
+    )
 
 from urllib.parse import quote
 
 
 @app.route("/accounting/debts", methods=["GET", "POST"])
 @login_required
-@permission_required("accounting_home")
 def accounting_debts():
     return accounting_debts_branch("ALL")
 
@@ -1353,7 +1761,7 @@ def build_debt_whatsapp_message(customer_name, remaining_amount):
 
 
 def has_debt_permission(es):
-    perms = session.get("perms") or {}
+    perms = current_perms()
 
     if es == "ALL":
         return (
@@ -1835,6 +2243,9 @@ def important_links():
 # Monthly Commission
 # =========================
 def ensure_monthly_commission_schema(db):
+    if app.config.get("COMMISSION_SCHEMA_READY"):
+        return
+
     db.execute("""
         CREATE TABLE IF NOT EXISTS monthly_commission_settings (
           id INTEGER PRIMARY KEY CHECK (id = 1),
@@ -1882,6 +2293,7 @@ def ensure_monthly_commission_schema(db):
          WHERE updated_at IS NULL
     """)
     db.commit()
+    app.config["COMMISSION_SCHEMA_READY"] = True
 
 
 def get_monthly_commission_settings(db) -> dict:
@@ -1914,7 +2326,6 @@ def calculate_monthly_commission(sales: float, settings: dict):
 
 @app.route("/accounting/monthly-commission", methods=["GET", "POST"])
 @login_required
-@permission_required("monthly_commission")
 def monthly_commission():
     db = get_db()
     settings = get_monthly_commission_settings(db)
@@ -1963,10 +2374,20 @@ def monthly_commission():
 
         total_commission, employee_commission = calculate_monthly_commission(sales, settings)
 
-        existing = db.execute("SELECT id FROM monthly_commissions WHERE month=?", (month,)).fetchone()
+        values = (
+            sales,
+            total_commission,
+            employee_commission,
+            settings["commission_rate"],
+            settings["fixed_deduction"],
+            settings["employees_count"],
+            month,
+        )
 
-        if existing:
-            db.execute("""
+        # تعديل الشهر مباشرة (بدون SELECT مسبق)، وإن لم يوجد نضيفه.
+        # الإضافة upsert حتى لا يفشل طلبان متزامنان لنفس الشهر على UNIQUE(month)
+        with db:
+            cur = db.execute("""
                 UPDATE monthly_commissions
                    SET sales_before_tax=?,
                        total_commission=?,
@@ -1976,45 +2397,35 @@ def monthly_commission():
                        employees_snapshot=?,
                        updated_at=datetime('now')
                  WHERE month=?
-            """, (
-                sales,
-                total_commission,
-                employee_commission,
-                settings["commission_rate"],
-                settings["fixed_deduction"],
-                settings["employees_count"],
-                month,
-            ))
-            db.commit()
-            row_id = int(existing["id"])
-            flash("تم تعديل العمولة", "success")
-        else:
-            cur = db.execute("""
-                INSERT INTO monthly_commissions
-                    (month, sales_before_tax, total_commission, employee_commission,
-                     rate_snapshot, deduction_snapshot, employees_snapshot,
-                     created_at, updated_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?, datetime('now'), datetime('now'))
-            """, (
-                month,
-                sales,
-                total_commission,
-                employee_commission,
-                settings["commission_rate"],
-                settings["fixed_deduction"],
-                settings["employees_count"],
-            ))
-            db.commit()
-            row_id = int(cur.lastrowid)
-            flash("تم حفظ العمولة", "success")
+            """, values)
+
+            if cur.rowcount:
+                flash("تم تعديل العمولة", "success")
+            else:
+                db.execute("""
+                    INSERT INTO monthly_commissions
+                        (sales_before_tax, total_commission, employee_commission,
+                         rate_snapshot, deduction_snapshot, employees_snapshot,
+                         month, created_at, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, datetime('now'), datetime('now'))
+                    ON CONFLICT(month) DO UPDATE SET
+                        sales_before_tax=excluded.sales_before_tax,
+                        total_commission=excluded.total_commission,
+                        employee_commission=excluded.employee_commission,
+                        rate_snapshot=excluded.rate_snapshot,
+                        deduction_snapshot=excluded.deduction_snapshot,
+                        employees_snapshot=excluded.employees_snapshot,
+                        updated_at=datetime('now')
+                """, values)
+                flash("تم حفظ العمولة", "success")
 
         # تصدير إلى Google Sheets
         try:
             r = db.execute("""
                 SELECT id, month, sales_before_tax, total_commission, employee_commission, updated_at
                   FROM monthly_commissions
-                 WHERE id=?
-            """, (row_id,)).fetchone()
+                 WHERE month=?
+            """, (month,)).fetchone()
 
             if r:
                 ws, err = open_ws(GS_TAB)
@@ -2057,21 +2468,35 @@ def monthly_commission():
 # =========================
 @app.route("/records")
 @login_required
-@permission_required("records_home")
 def records_home():
     return render_template("records_home.html")
 
 
-def table_name(kind: str):
-    kind = kind.upper()
-    if kind not in ("ES1", "ES2", "ES3"):
-        raise ValueError("Invalid kind")
-    return f"records_{kind.lower()}"
+# جدول records واحد لكل الأنواع (المفتاح kind + id)، فنفس الجملة المجهزة تخدم ES1/ES2/ES3
+_RECORDS_SQL = {
+    "list": "SELECT id, record_type, record_number, expiry_date FROM records WHERE kind=? ORDER BY id ASC",
+    "get": "SELECT id, record_type, record_number, expiry_date FROM records WHERE kind=? AND id=?",
+    # id لكل نوع من records_seq (أعلى id صدر) حتى لا يتكرر id محذوف، مثل AUTOINCREMENT سابقاً
+    "next_id": """
+        INSERT INTO records_seq (kind, last_id)
+        SELECT ?, COALESCE(MAX(id), 0) + 1 FROM records WHERE kind=?
+        ON CONFLICT(kind) DO UPDATE SET last_id = last_id + 1
+    """,
+    "last_id": "SELECT last_id FROM records_seq WHERE kind=?",
+    "insert": """
+        INSERT INTO records (kind, id, record_type, record_number, expiry_date)
+        VALUES (?, ?, ?, ?, ?)
+    """,
+    "update": "UPDATE records SET record_type=?, record_number=?, expiry_date=? WHERE kind=? AND id=?",
+    "delete": "DELETE FROM records WHERE kind=? AND id=?",
+}
+
+_RECORDS_GS_HEADERS = ["id", "record_type", "record_number", "expiry_date"]
 
 
 def require_records_perm(kind: str) -> bool:
     key = f"records_{kind.lower()}"
-    return bool((session.get("perms") or {}).get(key))
+    return bool(current_perms().get(key))
 
 
 @app.route("/records/<kind>")
@@ -2081,22 +2506,10 @@ def records_list(kind):
     if not require_records_perm(kind):
         return render_template("no_permission.html"), 403
 
-    t = table_name(kind)
     db = get_db()
-    rows = db.execute(
-        f"SELECT id, record_type, record_number, expiry_date FROM {t} ORDER BY id ASC"
-    ).fetchall()
-
-    data = []
-    for r in rows:
-        expiry = parse_date(r["expiry_date"]) if r["expiry_date"] else None
-        data.append({
-            "id": r["id"],
-            "record_type": r["record_type"],
-            "record_number": r["record_number"],
-            "expiry_date": expiry,
-        })
-    return render_template("records_list.html", kind=kind, rows=data)
+    rows = db.execute(_RECORDS_SQL["list"], (kind,)).fetchall()
+    # الصفوف تُمرر كما هي، وتحويل التاريخ يتم في القالب عبر فلتر date
+    return render_template("records_list.html", kind=kind, rows=rows)
 
 
 @app.route("/records/<kind>/new", methods=["GET", "POST"])
@@ -2106,8 +2519,6 @@ def record_new(kind):
     if not require_records_perm(kind):
         return render_template("no_permission.html"), 403
 
-    t = table_name(kind)
-
     # ===== GET =====
     if request.method == "GET":
         return render_template("record_form.html", kind=kind, mode="new", row=None)
@@ -2122,31 +2533,22 @@ def record_new(kind):
         return render_template("record_form.html", kind=kind, mode="new", row=None)
 
     db = get_db()
-    db.execute(
-        f"INSERT INTO {t} (record_type, record_number, expiry_date) VALUES (?, ?, ?)",
-        (record_type, record_number, expiry_date or None),
-    )
-    db.commit()
-    new_id = db.execute("SELECT last_insert_rowid()").fetchone()[0]
+    with db:
+        db.execute(_RECORDS_SQL["next_id"], (kind, kind))
+        new_id = db.execute(_RECORDS_SQL["last_id"], (kind,)).fetchone()[0]
+        db.execute(
+            _RECORDS_SQL["insert"],
+            (kind, new_id, record_type, record_number, expiry_date or None),
+        )
 
-    # --- Google Sheets export ---
-    try:
-        ws, err = open_ws(f"records_{kind.lower()}")
-        if not err:
-            headers = ["id", "record_type", "record_number", "expiry_date"]
-            ws_ensure_headers(ws, headers)
-
-            ok = ws_upsert(
-                ws,
-                headers,
-                [new_id, record_type, record_number, expiry_date or ""],
-                new_id
-            )
-            if ok is False:
-                print("records export failed (new):", kind, new_id)
-                flash("⚠️ فشل تصدير Google Sheets (records/new) راجع logs", "warning")
-    except Exception as e:
-        print("Google Sheets export (records/new) error:", e)
+    # --- Google Sheets export (في الخلفية) ---
+    gs_enqueue(
+        "upsert",
+        f"records_{kind.lower()}",
+        _RECORDS_GS_HEADERS,
+        [new_id, record_type, record_number, expiry_date or ""],
+        new_id,
+    )
 
     flash("تمت الإضافة بنجاح", "success")
     return redirect(url_for("records_list", kind=kind))
@@ -2159,11 +2561,10 @@ def record_edit(kind, rid: int):
     if not require_records_perm(kind):
         return render_template("no_permission.html"), 403
 
-    t = table_name(kind)
     db = get_db()
     row = db.execute(
-        f"SELECT id, record_type, record_number, expiry_date FROM {t} WHERE id=?",
-        (rid,),
+        _RECORDS_SQL["get"],
+        (kind, rid),
     ).fetchone()
 
     if row is None:
@@ -2180,30 +2581,18 @@ def record_edit(kind, rid: int):
             return render_template("record_form.html", kind=kind, mode="edit", row=row)
 
         db.execute(
-            f"UPDATE {t} SET record_type=?, record_number=?, expiry_date=? WHERE id=?",
-            (record_type, record_number, expiry_date or None, rid),
+            _RECORDS_SQL["update"],
+            (record_type, record_number, expiry_date or None, kind, rid),
         )
         db.commit()
 
-        ws, err = open_ws(f"records_{kind.lower()}")
-        if not err:
-            headers = ["id", "record_type", "record_number", "expiry_date"]
-
-            ws_ensure_headers(ws, headers)
-
-            ok = ws_upsert(
-                ws,
-                headers,
-                [rid, record_type, record_number, expiry_date or ""],
-                rid
-            )
-
-            if ok is False:
-                print("records export failed (edit):", kind, rid)
-                flash(
-                    "⚠️ فشل تصدير Google Sheets (records/edit) راجع logs",
-                    "warning"
-                )
+        gs_enqueue(
+            "upsert",
+            f"records_{kind.lower()}",
+            _RECORDS_GS_HEADERS,
+            [rid, record_type, record_number, expiry_date or ""],
+            rid,
+        )
 
         flash("تم التعديل بنجاح", "success")
         return redirect(url_for("records_list", kind=kind))
@@ -2218,14 +2607,11 @@ def record_delete(kind, rid: int):
     if not require_records_perm(kind):
         return render_template("no_permission.html"), 403
 
-    t = table_name(kind)
     db = get_db()
-    db.execute(f"DELETE FROM {t} WHERE id=?", (rid,))
+    db.execute(_RECORDS_SQL["delete"], (kind, rid))
     db.commit()
 
-    ws, err = open_ws(f"records_{kind.lower()}")
-    if not err:
-        ws_delete_by_id(ws, rid)
+    gs_enqueue("delete", f"records_{kind.lower()}", rid)
 
     flash("تم الحذف", "info")
     return redirect(url_for("records_list", kind=kind))
@@ -2235,6 +2621,10 @@ def record_delete(kind, rid: int):
 # =========================
 
 def ensure_employees_schema(db):
+    """Add late employees columns if missing (once per process)."""
+    if app.config.get("EMPLOYEES_SCHEMA_READY"):
+        return
+
     cols = [r[1] for r in db.execute("PRAGMA table_info(employees)").fetchall()]
 
     if "nationality" not in cols:
@@ -2247,11 +2637,73 @@ def ensure_employees_schema(db):
         db.execute("ALTER TABLE employees ADD COLUMN debts REAL NOT NULL DEFAULT 0")
 
     db.commit()
+    app.config["EMPLOYEES_SCHEMA_READY"] = True
+
+
+_EMP_GS_HEADERS = [
+    "id", "name_ar", "name_en", "nationality", "mobile",
+    "passport_no", "passport_expiry",
+    "iqama_no", "iqama_expiry",
+    "insurance_name", "insurance_expiry",
+    "basic_salary", "commission", "bank_account", "debts"
+]
+
+# حقول نموذج الموظف: (الاسم، النوع) — text نص، date نص أو None، num رقم
+_EMP_FIELDS = (
+    ("name_ar", "text"), ("name_en", "text"), ("nationality", "text"), ("mobile", "text"),
+    ("passport_no", "text"), ("passport_expiry", "date"),
+    ("iqama_no", "text"), ("iqama_expiry", "date"),
+    ("insurance_name", "text"), ("insurance_expiry", "date"),
+    ("basic_salary", "num"), ("commission", "num"), ("bank_account", "text"), ("debts", "num"),
+)
+
+
+def _employee_payload(form) -> dict:
+    """Employee form fields, stripped; empty dates become None and numbers floats."""
+    payload = {}
+    for k, kind in _EMP_FIELDS:
+        if kind == "num":
+            payload[k] = _to_float(form.get(k), 0)
+        else:
+            v = form.get(k, "").strip()
+            payload[k] = (v or None) if kind == "date" else v
+    return payload
+
+
+# نص ثابت على مستوى الوحدة حتى يصيب كاش الجمل في sqlite3 (cached_statements) دائماً
+_EMP_INSERT_SQL = """
+    INSERT INTO employees (
+      name_ar, name_en, nationality, mobile,
+      passport_no, passport_expiry,
+      iqama_no, iqama_expiry,
+      insurance_name, insurance_expiry,
+      basic_salary, commission, bank_account, debts
+    )
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+_EMP_UPDATE_SQL = """
+    UPDATE employees SET
+        name_ar=?,
+        name_en=?,
+        nationality=?,
+        mobile=?,
+        passport_no=?,
+        passport_expiry=?,
+        iqama_no=?,
+        iqama_expiry=?,
+        insurance_name=?,
+        insurance_expiry=?,
+        basic_salary=?,
+        commission=?,
+        bank_account=?,
+        debts=?
+    WHERE id=?
+"""
 
 
 @app.route("/employees")
 @login_required
-@permission_required("employees")
 def employees_list():
     db = get_db()
     ensure_employees_schema(db)
@@ -2266,68 +2718,32 @@ def employees_list():
         ORDER BY id ASC
     """).fetchall()
 
-    data = []
-    for r in rows:
-        data.append({
-            "id": r["id"],
-            "name_ar": r["name_ar"],
-            "name_en": r["name_en"],
-            "nationality": r["nationality"],
-            "mobile": r["mobile"],
-            "passport_no": r["passport_no"],
-            "passport_expiry": parse_date(r["passport_expiry"]) if r["passport_expiry"] else None,
-            "iqama_no": r["iqama_no"],
-            "iqama_expiry": parse_date(r["iqama_expiry"]) if r["iqama_expiry"] else None,
-            "insurance_name": r["insurance_name"],
-            "insurance_expiry": parse_date(r["insurance_expiry"]) if r["insurance_expiry"] else None,
-            "basic_salary": r["basic_salary"],
-            "commission": r["commission"],
-            "bank_account": r["bank_account"],
-            "debts": r["debts"],
-        })
-
-    return render_template("employees_list.html", rows=data)
+    # COUNT/MAX(id) لا يتغيران عند التعديل، فالـ ETag من الصفوف نفسها
+    etag = page_etag([tuple(r) for r in rows])
+    resp = not_modified(etag)
+    if resp is not None:
+        return resp
+
+    # الصفوف تُمرر كما هي، وتحويل التواريخ يتم في القالب عبر فلتر date
+    return with_etag(
+        app.make_response(render_template("employees_list.html", rows=rows)), etag
+    )
 
 
 @app.route("/employees/new", methods=["GET", "POST"])
 @login_required
-@permission_required("employees")
 def employee_new():
     db = get_db()
     ensure_employees_schema(db)
 
     if request.method == "POST":
-        payload = {
-            "name_ar": request.form.get("name_ar", "").strip(),
-            "name_en": request.form.get("name_en", "").strip(),
-            "nationality": request.form.get("nationality", "").strip(),
-            "mobile": request.form.get("mobile", "").strip(),
-            "passport_no": request.form.get("passport_no", "").strip(),
-            "passport_expiry": request.form.get("passport_expiry", "").strip() or None,
-            "iqama_no": request.form.get("iqama_no", "").strip(),
-            "iqama_expiry": request.form.get("iqama_expiry", "").strip() or None,
-            "insurance_name": request.form.get("insurance_name", "").strip(),
-            "insurance_expiry": request.form.get("insurance_expiry", "").strip() or None,
-            "basic_salary": _to_float(request.form.get("basic_salary"), 0),
-            "commission": _to_float(request.form.get("commission"), 0),
-            "bank_account": request.form.get("bank_account", "").strip(),
-            "debts": _to_float(request.form.get("debts"), 0),
-        }
+        payload = _employee_payload(request.form)
 
         if not payload["name_ar"]:
             flash("اسم الموظف بالعربي مطلوب", "warning")
             return render_template("employee_form.html", mode="new", row=None)
 
-        db.execute("""
-            INSERT INTO employees (
-              name_ar, name_en, nationality, mobile,
-              passport_no, passport_expiry,
-              iqama_no, iqama_expiry,
-              insurance_name, insurance_expiry,
-              basic_salary, commission, bank_account, debts
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
+        cur = db.execute(_EMP_INSERT_SQL, (
             payload["name_ar"],
             payload["name_en"],
             payload["nationality"],
@@ -2346,40 +2762,25 @@ def employee_new():
 
         db.commit()
 
-        new_id = db.execute("SELECT last_insert_rowid()").fetchone()[0]
+        new_id = cur.lastrowid
 
-        ws, err = open_ws("employees")
-        if not err:
-            headers = [
-                "id", "name_ar", "name_en", "nationality", "mobile",
-                "passport_no", "passport_expiry",
-                "iqama_no", "iqama_expiry",
-                "insurance_name", "insurance_expiry",
-                "basic_salary", "commission", "bank_account", "debts"
-            ]
-
-            ws_ensure_headers(ws, headers)
-
-            ok = ws_upsert(ws, headers, [
-                new_id,
-                payload["name_ar"],
-                payload["name_en"],
-                payload["nationality"],
-                payload["mobile"],
-                payload["passport_no"],
-                payload["passport_expiry"] or "",
-                payload["iqama_no"],
-                payload["iqama_expiry"] or "",
-                payload["insurance_name"],
-                payload["insurance_expiry"] or "",
-                payload["basic_salary"] or "",
-                payload["commission"] or "",
-                payload["bank_account"],
-                payload["debts"],
-            ], new_id)
-
-            if not ok:
-                flash("⚠️ فشل تصدير Google Sheets (employees/new) راجع logs", "warning")
+        gs_enqueue("upsert", "employees", _EMP_GS_HEADERS, [
+            new_id,
+            payload["name_ar"],
+            payload["name_en"],
+            payload["nationality"],
+            payload["mobile"],
+            payload["passport_no"],
+            payload["passport_expiry"] or "",
+            payload["iqama_no"],
+            payload["iqama_expiry"] or "",
+            payload["insurance_name"],
+            payload["insurance_expiry"] or "",
+            payload["basic_salary"] or "",
+            payload["commission"] or "",
+            payload["bank_account"],
+            payload["debts"],
+        ], new_id)
 
         flash("تمت إضافة الموظف", "success")
         return redirect(url_for("employees_list"))
@@ -2389,7 +2790,6 @@ def employee_new():
 
 @app.route("/employees/<int:eid>")
 @login_required
-@permission_required("employees")
 def employee_detail(eid: int):
     db = get_db()
     ensure_employees_schema(db)
@@ -2410,72 +2810,47 @@ def employee_detail(eid: int):
 
 @app.route("/employees/<int:eid>/edit", methods=["GET", "POST"])
 @login_required
-@permission_required("employees")
 def employee_edit(eid: int):
     db = get_db()
     ensure_employees_schema(db)
 
-    row_db = db.execute("SELECT * FROM employees WHERE id=?", (eid,)).fetchone()
+    def load_row():
+        row_db = db.execute("SELECT * FROM employees WHERE id=?", (eid,)).fetchone()
+        if row_db is None:
+            return None
 
-    if row_db is None:
-        flash("الموظف غير موجود", "danger")
-        return redirect(url_for("employees_list"))
+        row = dict(row_db)
 
-    row = dict(row_db)
+        for k in [
+            "name_ar", "name_en", "nationality", "mobile",
+            "passport_no", "passport_expiry",
+            "iqama_no", "iqama_expiry",
+            "insurance_name", "insurance_expiry",
+            "bank_account"
+        ]:
+            row[k] = row.get(k) or ""
 
-    for k in [
-        "name_ar", "name_en", "nationality", "mobile",
-        "passport_no", "passport_expiry",
-        "iqama_no", "iqama_expiry",
-        "insurance_name", "insurance_expiry",
-        "bank_account"
-    ]:
-        row[k] = row.get(k) or ""
+        row["basic_salary"] = row.get("basic_salary") or 0
+        row["commission"] = row.get("commission") or 0
+        row["debts"] = row.get("debts") or 0
+        return row
 
-    row["basic_salary"] = row.get("basic_salary") or 0
-    row["commission"] = row.get("commission") or 0
-    row["debts"] = row.get("debts") or 0
+    def not_found():
+        flash("الموظف غير موجود", "danger")
+        return redirect(url_for("employees_list"))
 
+    # POST لا يحتاج قراءة الصف مسبقاً: UPDATE مباشرة و rowcount يكشف غير الموجود
     if request.method == "POST":
-        payload = {
-            "name_ar": request.form.get("name_ar", "").strip(),
-            "name_en": request.form.get("name_en", "").strip(),
-            "nationality": request.form.get("nationality", "").strip(),
-            "mobile": request.form.get("mobile", "").strip(),
-            "passport_no": request.form.get("passport_no", "").strip(),
-            "passport_expiry": request.form.get("passport_expiry", "").strip() or None,
-            "iqama_no": request.form.get("iqama_no", "").strip(),
-            "iqama_expiry": request.form.get("iqama_expiry", "").strip() or None,
-            "insurance_name": request.form.get("insurance_name", "").strip(),
-            "insurance_expiry": request.form.get("insurance_expiry", "").strip() or None,
-            "basic_salary": _to_float(request.form.get("basic_salary"), 0),
-            "commission": _to_float(request.form.get("commission"), 0),
-            "bank_account": request.form.get("bank_account", "").strip(),
-            "debts": _to_float(request.form.get("debts"), 0),
-        }
+        payload = _employee_payload(request.form)
 
         if not payload["name_ar"]:
+            row = load_row()
+            if row is None:
+                return not_found()
             flash("اسم الموظف بالعربي مطلوب", "warning")
             return render_template("employee_form.html", mode="edit", row=row)
 
-        db.execute("""
-            UPDATE employees SET
-                name_ar=?,
-                name_en=?,
-                nationality=?,
-                mobile=?,
-                passport_no=?,
-                passport_expiry=?,
-                iqama_no=?,
-                iqama_expiry=?,
-                insurance_name=?,
-                insurance_expiry=?,
-                basic_salary=?,
-                commission=?,
-                bank_account=?,
-                debts=?
-            WHERE id=?
-        """, (
+        cur = db.execute(_EMP_UPDATE_SQL, (
             payload["name_ar"],
             payload["name_en"],
             payload["nationality"],
@@ -2493,55 +2868,41 @@ def employee_edit(eid: int):
             eid,
         ))
 
-        db.commit()
+        if cur.rowcount == 0:
+            db.rollback()
+            return not_found()
 
-        try:
-            ws, err = open_ws("employees")
-
-            if not err:
-                headers = [
-                    "id", "name_ar", "name_en", "nationality", "mobile",
-                    "passport_no", "passport_expiry",
-                    "iqama_no", "iqama_expiry",
-                    "insurance_name", "insurance_expiry",
-                    "basic_salary", "commission", "bank_account", "debts"
-                ]
-
-                ws_ensure_headers(ws, headers)
-
-                ok = ws_upsert(ws, headers, [
-                    eid,
-                    payload["name_ar"],
-                    payload["name_en"],
-                    payload["nationality"],
-                    payload["mobile"],
-                    payload["passport_no"],
-                    payload["passport_expiry"] or "",
-                    payload["iqama_no"],
-                    payload["iqama_expiry"] or "",
-                    payload["insurance_name"],
-                    payload["insurance_expiry"] or "",
-                    payload["basic_salary"] or "",
-                    payload["commission"] or "",
-                    payload["bank_account"],
-                    payload["debts"],
-                ], eid)
-
-                if not ok:
-                    flash("⚠️ تم حفظ التعديل، لكن فشل تصدير Google Sheets", "warning")
+        db.commit()
 
-        except Exception as e:
-            print("employees/edit google sheets error:", e)
-            flash("⚠️ تم حفظ التعديل، لكن فشل تصدير Google Sheets", "warning")
+        gs_enqueue("upsert", "employees", _EMP_GS_HEADERS, [
+            eid,
+            payload["name_ar"],
+            payload["name_en"],
+            payload["nationality"],
+            payload["mobile"],
+            payload["passport_no"],
+            payload["passport_expiry"] or "",
+            payload["iqama_no"],
+            payload["iqama_expiry"] or "",
+            payload["insurance_name"],
+            payload["insurance_expiry"] or "",
+            payload["basic_salary"] or "",
+            payload["commission"] or "",
+            payload["bank_account"],
+            payload["debts"],
+        ], eid)
 
         flash("تم تعديل بيانات الموظف", "success")
         return redirect(url_for("employee_detail", eid=eid))
 
+    row = load_row()
+    if row is None:
+        return not_found()
+
     return render_template("employee_form.html", mode="edit", row=row)
 
 @app.route("/employees/<int:eid>/delete", methods=["POST"])
 @login_required
-@permission_required("employees")
 def employee_delete(eid: int):
     db = get_db()
     ensure_employees_schema(db)
@@ -2561,14 +2922,7 @@ def employee_delete(eid: int):
         flash("تعذر حذف الموظف من قاعدة البيانات", "danger")
         return redirect(url_for("employees_list"))
 
-    try:
-        ws, err = open_ws("employees")
-        if not err:
-            ws_delete_by_id(ws, eid)
-    except Exception as e:
-        print("employee_delete google sheets error:", e)
-        flash("تم حذف الموظف، لكن فشل حذف السطر من Google Sheets", "warning")
-        return redirect(url_for("employees_list"))
+    gs_enqueue("delete", "employees", eid)
 
     flash("تم حذف الموظف", "info")
     return redirect(url_for("employees_list"))# =========================
@@ -2576,7 +2930,6 @@ def employee_delete(eid: int):
 # =========================
 @app.route("/tasks", methods=["GET", "POST"])
 @login_required
-@permission_required("tasks")
 def tasks():
     db = get_db()
 
@@ -2593,23 +2946,21 @@ def tasks():
 
         if title:
             created_at = datetime.now().isoformat()
-            db.execute(
+            cur = db.execute(
                 "INSERT INTO tasks (title, due_date, created_at) VALUES (?, ?, ?)",
                 (title, due_date, created_at),
             )
             db.commit()
-            new_id = db.execute("SELECT last_insert_rowid()").fetchone()[0]
-
-            # Google Sheets (tasks_manual)
-            try:
-                ws, err = open_ws("tasks_manual")
-                if not err:
-                    headers = ["id", "title", "due_date", "created_at"]
-                    ok = ws_upsert(ws, headers, [new_id, title, due_date or "", created_at], new_id)
-                    if not ok:
-                        flash("⚠️ فشل تصدير Google Sheets (tasks_manual/add) راجع logs", "warning")
-            except Exception as e:
-                print("Google Sheets export (tasks_manual) error:", e)
+            new_id = cur.lastrowid
+
+            # Google Sheets (tasks_manual) في الخلفية
+            gs_enqueue(
+                "upsert",
+                "tasks_manual",
+                ["id", "title", "due_date", "created_at"],
+                [new_id, title, due_date or "", created_at],
+                new_id,
+            )
 
         return redirect(url_for("tasks"))
 
@@ -2641,78 +2992,86 @@ def tasks():
         tasks_list = []
 
     # (C) التنبيهات (سجلات + موظفين) ضمن 45 يوم
-    alerts = []
     DAYS_WINDOW = 45
 
+    # تاريخ اليوم مرة واحدة لكل الصفوف
+    today = date.today()
+
     def _safe_fromiso(s):
+        s = (s or "").strip()
+        # المسار السريع: YYYY-MM-DD (المخزّن من حقول type=date) بدون المرور بالـ parser
+        if len(s) == 10 and s[4] == "-" and s[7] == "-":
+            y, m, d = s[:4], s[5:7], s[8:]
+            if y.isdigit() and m.isdigit() and d.isdigit():
+                try:
+                    return date(int(y), int(m), int(d))
+                except ValueError:
+                    return None
+        if not s:
+            return None
         try:
-            return date.fromisoformat((s or "").strip())
-        except Exception:
+            return date.fromisoformat(s)
+        except ValueError:
             return None
 
-    # سجلات ES1/ES2/ES3
-    for kind in ("ES1", "ES2", "ES3"):
-        table = f"records_{kind.lower()}"
-        try:
-            recs = db.execute(f"""
-                SELECT record_type, record_number, expiry_date
-                  FROM {table}
-                 WHERE expiry_date IS NOT NULL AND expiry_date <> ''
-            """).fetchall()
-        except Exception as e:
-            print(f"records table error ({table}):", e)
-            recs = []
-
-        for r in recs:
-            d = _safe_fromiso(r["expiry_date"])
-            if not d:
-                continue
-            dl = (d - date.today()).days
-            if dl > DAYS_WINDOW:
-                continue
-
-            alerts.append({
-                "source": kind,
-                "name": r["record_type"] or "",
-                "number": r["record_number"] or "",
-                "expiry": d.isoformat(),
-                "days_left": dl,
-                "color": status_color(d),
-            })
-
-    # موظفين: جواز/إقامة/تأمين
-    try:
-        emp_rows = db.execute("""
-            SELECT name_ar, passport_expiry, iqama_expiry, insurance_expiry
-              FROM employees
-        """).fetchall()
-    except Exception as e:
-        print("employees alerts error:", e)
-        emp_rows = []
+    # التواريخ مخزنة YYYY-MM-DD فالمقارنة النصية تكفي لاستبعاد ما بعد النافذة داخل SQLite
+    cutoff = (today + timedelta(days=DAYS_WINDOW)).isoformat()
 
-    def add_emp_alert(title, expiry):
+    def _alert(source, name, number, expiry):
         d = _safe_fromiso(expiry)
         if not d:
-            return
-        dl = (d - date.today()).days
+            return None
+        dl = (d - today).days
         if dl > DAYS_WINDOW:
-            return
-        alerts.append({
-            "source": "الموظفين",
-            "name": title,
-            "number": "-",
+            return None
+        return {
+            "source": source,
+            "name": name,
+            "number": number,
             "expiry": d.isoformat(),
             "days_left": dl,
-            "color": status_color(d),
-        })
+            "color": _status_for_days(dl),
+        }
 
-    for e in emp_rows:
-        name = (e["name_ar"] or "").strip()
-        add_emp_alert(f"انتهاء جواز {name}", e["passport_expiry"])
-        add_emp_alert(f"انتهاء إقامة {name}", e["iqama_expiry"])
-        add_emp_alert(f"انتهاء تأمين {name}", e["insurance_expiry"])
+    # سجلات ES1/ES2/ES3 (مرتبة حسب تاريخ الانتهاء من SQLite)
+    rec_alerts = []
+    try:
+        for r in db.execute("""
+            SELECT kind, record_type, record_number, expiry_date
+              FROM records
+             WHERE expiry_date <> '' AND expiry_date <= ?
+             ORDER BY expiry_date, kind, id
+        """, (cutoff,)):
+            a = _alert(r["kind"], r["record_type"] or "", r["record_number"] or "", r["expiry_date"])
+            if a:
+                rec_alerts.append(a)
+    except Exception as e:
+        print("records table error:", e)
+
+    # موظفين: جواز/إقامة/تأمين — كل عمود فرع مستقل على فهرسه، والترتيب من SQLite
+    emp_titles = {1: "انتهاء جواز", 2: "انتهاء إقامة", 3: "انتهاء تأمين"}
+    emp_alerts = []
+    try:
+        for e in db.execute("""
+            SELECT id, 1 AS f, name_ar, passport_expiry AS expiry
+              FROM employees WHERE passport_expiry <> '' AND passport_expiry <= ?
+            UNION ALL
+            SELECT id, 2, name_ar, iqama_expiry
+              FROM employees WHERE iqama_expiry <> '' AND iqama_expiry <= ?
+            UNION ALL
+            SELECT id, 3, name_ar, insurance_expiry
+              FROM employees WHERE insurance_expiry <> '' AND insurance_expiry <= ?
+            ORDER BY expiry, id, f
+        """, (cutoff, cutoff, cutoff)):
+            name = (e["name_ar"] or "").strip()
+            a = _alert("الموظفين", f"{emp_titles[e['f']]} {name}", "-", e["expiry"])
+            if a:
+                emp_alerts.append(a)
+    except Exception as e:
+        print("employees alerts error:", e)
 
-    alerts.sort(key=lambda x: x["expiry"] or "9999-12-31")
+    # القائمتان مرتبتان: دمج خطي بدل sort (السجلات أولاً عند تساوي التاريخ كما كان)
+    alerts = list(heapq.merge(rec_alerts, emp_alerts, key=lambda x: x["expiry"]))
     # --- تصدير tasks_auto (Snapshot) ---
        # --- تصدير tasks_auto (Snapshot) ---
     try:
@@ -2748,7 +3107,6 @@ def tasks():
 
 @app.route("/tasks/<int:tid>/delete", methods=["POST"])
 @login_required
-@permission_required("tasks")
 def task_delete(tid: int):
     db = get_db()
 
@@ -2766,12 +3124,7 @@ def task_delete(tid: int):
     db.execute("DELETE FROM tasks WHERE id=?", (tid,))
     db.commit()
 
-    try:
-        ws, err = open_ws("tasks_manual")
-        if not err:
-            ws_delete_by_id(ws, tid)
-    except Exception as e:
-        print("Google Sheets delete (tasks_manual) error:", e)
+    gs_enqueue("delete", "tasks_manual", tid)
 
     flash("تم حذف المهمة اليدوية", "info")
     return redirect(url_for("tasks"))
@@ -2794,24 +3147,27 @@ def permissions_page():
             flash("اسم المستخدم وكلمة المرور مطلوبة", "warning")
             return redirect(url_for("permissions_page"))
 
-        try:
-            db.execute(
-                "INSERT INTO users (username, password_hash, is_admin, created_at) VALUES (?, ?, 0, ?)",
-                (username, generate_password_hash(password), datetime.now().isoformat()),
+        with db:
+            # الاسم المكرر لا يرمي IntegrityError؛ rowcount=0 يكفي
+            cur = db.execute(
+                "INSERT INTO users (username, password_hash, is_admin, created_at) "
+                "VALUES (?, ?, 0, strftime('%Y-%m-%dT%H:%M:%f', 'now')) "
+                "ON CONFLICT(username) DO NOTHING",
+                (username, generate_password_hash(password)),
             )
-            db.commit()
+            uid = cur.lastrowid if cur.rowcount else None
 
-            uid = db.execute("SELECT id FROM users WHERE username=?", (username,)).fetchone()["id"]
-            for k in PERM_KEYS:
-                db.execute(
+            if uid is not None:
+                db.executemany(
                     "INSERT INTO permissions (user_id, perm_key, allowed) VALUES (?, ?, 0)",
-                    (uid, k),
+                    [(uid, k) for k in PERM_KEYS],
                 )
-            db.commit()
 
-            flash("تم إضافة المستخدم", "success")
-        except sqlite3.IntegrityError:
+        if uid is None:
             flash("اسم المستخدم موجود مسبقاً", "danger")
+        else:
+            invalidate_user_perms(uid)
+            flash("تم إضافة المستخدم", "success")
 
         return redirect(url_for("permissions_page"))
 
@@ -2819,27 +3175,29 @@ def permissions_page():
         uid = int(request.form.get("uid", "0") or 0)
 
         new_pass = request.form.get("password", "").strip()
-        if new_pass:
-            db.execute(
-                "UPDATE users SET password_hash=? WHERE id=?",
-                (generate_password_hash(new_pass), uid),
-            )
 
-        for k in PERM_KEYS:
-            allowed = 1 if request.form.get(f"perm_{k}") == "on" else 0
-            db.execute(
+        with db:
+            if new_pass:
+                db.execute(
+                    "UPDATE users SET password_hash=? WHERE id=?",
+                    (generate_password_hash(new_pass), uid),
+                )
+
+            db.executemany(
                 """
                 INSERT INTO permissions (user_id, perm_key, allowed)
                 VALUES (?, ?, ?)
                 ON CONFLICT(user_id, perm_key) DO UPDATE SET allowed=excluded.allowed
                 """,
-                (uid, k, allowed),
+                [
+                    (uid, k, 1 if request.form.get(f) == "on" else 0)
+                    for f, k in _PERM_FORM_KEYS
+                ],
             )
 
-        db.commit()
-
-        if session.get("user_id") == uid:
-            session["perms"] = load_user_perms(uid)
+        invalidate_user_perms(uid)
+        if new_pass:
+            invalidate_login_cache()
 
         flash("تم تحديث الصلاحيات", "success")
         return redirect(url_for("permissions_page"))
@@ -2855,18 +3213,22 @@ def permissions_page():
         db.execute("DELETE FROM permissions WHERE user_id=?", (uid,))
         db.execute("DELETE FROM users WHERE id=?", (uid,))
         db.commit()
+        invalidate_user_perms(uid)
+        invalidate_login_cache()
 
         flash("تم حذف المستخدم", "info")
         return redirect(url_for("permissions_page"))
 
     users = db.execute("SELECT id, username FROM users ORDER BY id ASC").fetchall()
-    user_perms = {}
-    for u in users:
-        pr = db.execute(
-            "SELECT perm_key, allowed FROM permissions WHERE user_id=?",
-            (u["id"],),
-        ).fetchall()
-        user_perms[u["id"]] = {r["perm_key"]: bool(r["allowed"]) for r in pr}
+    user_perms = {u["id"]: {k: False for k in PERM_KEYS} for u in users}
+
+    for r in db.execute("""
+        SELECT p.user_id, p.perm_key, p.allowed
+          FROM permissions p
+          JOIN users u ON u.id = p.user_id
+         ORDER BY p.user_id
+    """):
+        user_perms[r["user_id"]][r["perm_key"]] = bool(r["allowed"])
 
     return render_template(
         "permissions.html",
@@ -2885,5 +3247,8 @@ if __name__ == "__main__":
     # أول مرة فقط إذا قاعدة البيانات جديدة:
     # init_db()
 
+    with app.app_context():
+        bootstrap_once()
+
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port)
@@ -8,7 +8,7 @@ CREATE TABLE IF NOT EXISTS users (
   username TEXT NOT NULL UNIQUE,
   password_hash TEXT NOT NULL,
   is_admin INTEGER NOT NULL DEFAULT 0,
-  created_at TEXT
+  created_at TEXT DEFAULT (strftime('%Y-%m-%dT%H:%M:%f', 'now'))
 );
 
 -- =========================
@@ -52,27 +52,23 @@ VALUES
 (1, 0.008, 200, 6, datetime('now'));
 
 -- =========================
--- records tables
+-- records (ES1 / ES2 / ES3 في جدول واحد، id متسلسل لكل kind)
 -- =========================
-CREATE TABLE IF NOT EXISTS records_es1 (
-  id INTEGER PRIMARY KEY AUTOINCREMENT,
+CREATE TABLE IF NOT EXISTS records (
+  kind TEXT NOT NULL,
+  id INTEGER NOT NULL,
   record_type TEXT,
   record_number TEXT NOT NULL,
-  expiry_date TEXT
+  expiry_date TEXT,
+  PRIMARY KEY (kind, id)
 );
 
-CREATE TABLE IF NOT EXISTS records_es2 (
-  id INTEGER PRIMARY KEY AUTOINCREMENT,
-  record_type TEXT,
-  record_number TEXT NOT NULL,
-  expiry_date TEXT
-);
+CREATE INDEX IF NOT EXISTS idx_records_expiry ON records(expiry_date);
 
-CREATE TABLE IF NOT EXISTS records_es3 (
-  id INTEGER PRIMARY KEY AUTOINCREMENT,
-  record_type TEXT,
-  record_number TEXT NOT NULL,
-  expiry_date TEXT
+-- أعلى id صدر لكل kind: الـ id المحذوف لا يُعاد استخدامه
+CREATE TABLE IF NOT EXISTS records_seq (
+  kind TEXT PRIMARY KEY,
+  last_id INTEGER NOT NULL
 );
 
 -- =========================
@@ -100,6 +96,10 @@ CREATE TABLE IF NOT EXISTS employees (
   debts REAL NOT NULL DEFAULT 0
 );
 
+CREATE INDEX IF NOT EXISTS idx_emp_passport_expiry ON employees(passport_expiry);
+CREATE INDEX IF NOT EXISTS idx_emp_iqama_expiry ON employees(iqama_expiry);
+CREATE INDEX IF NOT EXISTS idx_emp_insurance_expiry ON employees(insurance_expiry);
+
 -- =========================
 -- manual tasks
 -- =========================
@@ -107,7 +107,7 @@ CREATE TABLE IF NOT EXISTS tasks (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   title TEXT NOT NULL,
   due_date TEXT,
-  created_at TEXT
+  created_at TEXT DEFAULT (strftime('%Y-%m-%dT%H:%M:%f', 'now'))
 );
 
 -- =========================
@@ -190,8 +190,13 @@ CREATE TABLE IF NOT EXISTS daily_expenses_petty (
   FOREIGN KEY (header_id) REFERENCES daily_header(id) ON DELETE CASCADE
 );
 
-CREATE INDEX IF NOT EXISTS idx_daily_header_es_date
-ON daily_header(es, day_date);
+CREATE INDEX IF NOT EXISTS idx_daily_header_es_date_cov
+ON daily_header(es, day_date, cash_start, cash_end, cash_received, mada, total_in_enjaz);
+
+CREATE INDEX IF NOT EXISTS idx_di_header ON daily_inputs(header_id, amount);
+CREATE INDEX IF NOT EXISTS idx_dte_header ON daily_tamara_emkan(header_id, amount);
+CREATE INDEX IF NOT EXISTS idx_deg_header ON daily_expenses_general(header_id, amount);
+CREATE INDEX IF NOT EXISTS idx_dep_header ON daily_expenses_petty(header_id, amount);
 
 -- =========================
 -- Financial Commitments